@@ -6,41 +6,183 @@ uses OSRA for real molecule recognition, and returns SMILES strings.
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 import subprocess
 import tempfile
+import hashlib
+import threading
+import time
 import os
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps, ImageStat
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
 from io import BytesIO
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for browser extension
+# Reject oversized uploads (mainly batch requests) before they are parsed
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
 
+# Lookup table for grey-background suppression: anything lighter than
+# ~60% grey (pixel value 160) is pushed to white. Built once so that
+# image.point() applies it directly instead of calling a lambda per level.
+_GREY_SUPPRESS_LUT = bytes(255 if p > 160 else p for p in range(256))
 
-def recognize_molecule_with_osra(image_path):
+# The same suppression composed with inversion, so dark-theme captures are
+# inverted and cleaned in a single pass over the pixels.
+_INVERTED_GREY_SUPPRESS_LUT = bytes(_GREY_SUPPRESS_LUT[255 - p] for p in range(256))
+
+# Cached OSRA probe result as (available, accepts_stdin, timestamp).
+# Health checks are polled frequently; re-running the subprocess on each
+# poll is wasted work, so the result is refreshed at most once a minute.
+_OSRA_PROBE_TTL = 60
+_osra_probe_lock = threading.Lock()
+_osra_probe_cache = None
+
+
+def _probe_osra():
+    """Run `osra --version` and report whether it succeeded."""
+    try:
+        result = subprocess.run(['osra', '--version'], capture_output=True, timeout=5)
+        return result.returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+# LRU cache of recognized SMILES keyed by SHA-256 of the preprocessed PNG.
+# Re-submitting the same capture (user re-clicks, extension retries) then
+# skips the OSRA subprocess entirely.
+_SMILES_CACHE_SIZE = 1024
+_smiles_cache_lock = threading.Lock()
+_smiles_cache = OrderedDict()
+
+
+def _get_cached_smiles(key):
+    """Return the cached SMILES for an image hash, or None on a miss."""
+    with _smiles_cache_lock:
+        smiles = _smiles_cache.get(key)
+        if smiles is not None:
+            _smiles_cache.move_to_end(key)
+        return smiles
+
+
+def _cache_smiles(key, smiles):
+    """Store a recognized SMILES, evicting the least recently used entry."""
+    with _smiles_cache_lock:
+        _smiles_cache[key] = smiles
+        _smiles_cache.move_to_end(key)
+        if len(_smiles_cache) > _SMILES_CACHE_SIZE:
+            _smiles_cache.popitem(last=False)
+
+
+def _run_osra(image_path, input_bytes=None):
+    """
+    Run the OSRA command on a single image.
+
+    Args:
+        image_path: Path to the image file (or /dev/stdin)
+        input_bytes: Image bytes to feed on stdin, if any
+
+    Returns:
+        subprocess.CompletedProcess with bytes stdout/stderr
+    """
+    # Options:
+    # -f smi: output SMILES format
+    # -p: disable perception of functional groups (faster)
+    return subprocess.run(
+        ['osra', '-f', 'smi', image_path],
+        input=input_bytes,
+        capture_output=True,
+        timeout=30
+    )
+
+
+def _probe_osra_stdin():
+    """
+    Check whether this OSRA build can read its image from /dev/stdin.
+    Piping avoids a temp-file round-trip per request; builds or platforms
+    that reject it fall back to writing a temporary file.
+    """
+    buffer = BytesIO()
+    Image.new('L', (64, 64), 255).save(buffer, 'PNG')
+    try:
+        result = _run_osra('/dev/stdin', buffer.getvalue())
+        return result.returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+def _osra_status():
+    """
+    Return the cached (available, accepts_stdin, timestamp) probe result,
+    refreshing it when older than the probe interval. The stdin probe is a
+    full OSRA run, so it is only repeated when OSRA has just become
+    available, and the lock keeps concurrent callers from probing twice.
+    """
+    global _osra_probe_cache
+    with _osra_probe_lock:
+        if _osra_probe_cache is None or time.time() - _osra_probe_cache[2] >= _OSRA_PROBE_TTL:
+            available = _probe_osra()
+            if not available:
+                accepts_stdin = False
+            elif _osra_probe_cache is not None and _osra_probe_cache[0]:
+                accepts_stdin = _osra_probe_cache[1]
+            else:
+                accepts_stdin = _probe_osra_stdin()
+            _osra_probe_cache = (available, accepts_stdin, time.time())
+        return _osra_probe_cache
+
+
+def is_osra_available():
+    """
+    Report whether OSRA is installed, using a cached probe result.
+
+    Returns:
+        True if `osra --version` succeeded within the last probe interval
+    """
+    return _osra_status()[0]
+
+
+def _osra_accepts_stdin():
+    """Report whether OSRA input can be piped via /dev/stdin."""
+    return _osra_status()[1]
+
+
+# Probe once at import, so neither the startup banner nor the first
+# request (under `python server.py` or Gunicorn) pays for it.
+_osra_status()
+
+
+def recognize_molecule_with_osra(png_bytes):
     """
     Use OSRA (Optical Structure Recognition Application) to recognize
     molecular structures from images.
 
     Args:
-        image_path: Path to the image file
+        png_bytes: PNG-encoded image data
 
     Returns:
         SMILES string or None if recognition failed
     """
     try:
         # Run OSRA command
-        # Options:
-        # -f smi: output SMILES format
-        # -p: disable perception of functional groups (faster)
-        result = subprocess.run(
-            ['osra', '-f', 'smi', image_path],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
+        if _osra_accepts_stdin():
+            result = _run_osra('/dev/stdin', png_bytes)
+        else:
+            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
+                temp_path = temp_file.name
+                temp_file.write(png_bytes)
+            try:
+                result = _run_osra(temp_path)
+            finally:
+                # Clean up temp file
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
 
         if result.returncode == 0:
-            smiles = result.stdout.strip()
+            smiles = result.stdout.decode(errors='replace').strip()
             if smiles:
                 # OSRA outputs format: "SMILES name"
                 # Extract just the SMILES part
@@ -48,7 +190,7 @@ def recognize_molecule_with_osra(image_path):
                 if smiles_parts:
                     return smiles_parts[0]
 
-        print(f"OSRA stderr: {result.stderr}")
+        print(f"OSRA stderr: {result.stderr.decode(errors='replace')}")
         return None
 
     except subprocess.TimeoutExpired:
@@ -62,45 +204,38 @@ def recognize_molecule_with_osra(image_path):
         return None
 
 
-def _otsu_threshold(image):
+def _otsu_threshold(histogram):
     """
     Compute the optimal binary threshold using Otsu's method.
     Uses the image histogram to find the threshold that minimizes
     intra-class variance between foreground and background pixels.
 
     Args:
-        image: PIL Image in 'L' (grayscale) mode
+        histogram: 256-bin NumPy histogram of a grayscale image
 
     Returns:
         Optimal threshold value (0-255)
     """
-    histogram = image.histogram()
-    total_pixels = image.size[0] * image.size[1]
-    total_sum = sum(i * histogram[i] for i in range(256))
-
-    best_threshold = 128
-    best_variance = 0
-    weight_bg = 0
-    sum_bg = 0
+    levels = np.arange(256, dtype=np.float64)
+    total_pixels = histogram.sum()
+    total_sum = (histogram * levels).sum()
 
-    for t in range(256):
-        weight_bg += histogram[t]
-        if weight_bg == 0:
-            continue
-        weight_fg = total_pixels - weight_bg
-        if weight_fg == 0:
-            break
+    # Cumulative class weights and intensity sums for every candidate
+    # threshold at once, instead of accumulating them in a Python loop.
+    weight_bg = np.cumsum(histogram)
+    sum_bg = np.cumsum(histogram * levels)
+    weight_fg = total_pixels - weight_bg
 
-        sum_bg += t * histogram[t]
-        mean_bg = sum_bg / weight_bg
-        mean_fg = (total_sum - sum_bg) / weight_fg
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (total_sum - sum_bg) / np.maximum(weight_fg, 1)
 
-        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
-        if variance > best_variance:
-            best_variance = variance
-            best_threshold = t
+    variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    variance[(weight_bg == 0) | (weight_fg == 0)] = -np.inf
 
-    return best_threshold
+    # Single-valued images have no valid split; keep the old default.
+    if not np.isfinite(variance).any() or variance.max() <= 0:
+        return 128
+    return int(np.argmax(variance))
 
 
 def preprocess_image(image):
@@ -113,7 +248,8 @@ def preprocess_image(image):
         image: PIL Image object (from browser extension screenshot)
 
     Returns:
-        Preprocessed PIL Image ready for OSRA
+        Tuple of (preprocessed PIL Image ready for OSRA, fraction of black
+        pixels in the binarized image before padding)
     """
     # Step 1: Flatten transparency onto white background
     # Browser screenshots may be RGBA PNGs; without this, transparent
@@ -130,18 +266,34 @@ def preprocess_image(image):
     elif image.mode != 'RGB':
         image = image.convert('RGB')
 
+    # Cap the working resolution up front so every later step runs on at
+    # most 1500px along the longest side. Bilinear is sufficient here.
+    if max(image.size) > 1500:
+        image.thumbnail((1500, 1500), Image.BILINEAR)
+
     # Step 2: Convert to grayscale
     # OSRA only uses luminance; removing color prevents issues with
     # colored heteroatom labels (blue N, red O) being lost during
     # OSRA's internal conversion.
     image = image.convert('L')
 
+    # Steps 3-6 are all per-level pixel maps, so they are composed into a
+    # single 256-entry lookup table. The histogram of each intermediate
+    # image is derived by remapping the original histogram through the
+    # table built so far, and the pixels are only touched by the final
+    # image.point() call.
+    levels = np.arange(256)
+    histogram = np.asarray(image.histogram(), dtype=np.float64)
+    total_pixels = histogram.sum()
+
     # Step 3: Inversion detection for dark-theme websites
     # If mean pixel value is dark, the image is likely white-on-dark
     # (dark theme). OSRA expects dark lines on light background.
-    mean_val = ImageStat.Stat(image).mean[0]
+    mean_val = (histogram * levels).sum() / total_pixels
     if mean_val < 128:
-        image = ImageOps.invert(image)
+        grey_lut = _INVERTED_GREY_SUPPRESS_LUT
+    else:
+        grey_lut = _GREY_SUPPRESS_LUT
 
     # Step 4: Remove grey background artifacts (watermarks, shading)
     # Watermarks and background artifacts appear as light-to-mid grey
@@ -149,24 +301,40 @@ def preprocess_image(image):
     # suppress anything lighter than a cutoff by pushing it to white,
     # preserving only the dark bond lines and atom labels.
     # Cutoff at ~60% grey (pixel value 160): anything lighter is background.
-    image = image.point(lambda p: 255 if p > 160 else p, mode='L')
+    tone_lut = np.frombuffer(grey_lut, dtype=np.uint8)
 
     # Step 5: Contrast enhancement
     # Web-rendered structures often have light gray lines on slightly
     # off-white backgrounds. Boosting contrast makes faint lines darker
-    # and backgrounds whiter before thresholding.
-    image = ImageEnhance.Contrast(image).enhance(1.5)
+    # and backgrounds whiter before thresholding. This reproduces
+    # ImageEnhance.Contrast(1.5): blend away from the rounded mean level.
+    grey_histogram = np.bincount(tone_lut, weights=histogram, minlength=256)
+    contrast_mean = int((grey_histogram * levels).sum() / total_pixels + 0.5)
+    contrast_lut = np.clip(contrast_mean + 1.5 * (levels - contrast_mean), 0, 255).astype(np.uint8)
+    tone_lut = contrast_lut[tone_lut]
 
     # Step 6: Binary thresholding (Otsu's method)
     # Produces clean black/white output. Otsu's method adapts to the
     # actual intensity distribution, which varies across websites.
-    threshold = _otsu_threshold(image)
-    image = image.point(lambda p: 255 if p > threshold else 0, mode='L')
+    contrast_histogram = np.bincount(tone_lut, weights=histogram, minlength=256)
+    threshold = _otsu_threshold(contrast_histogram)
+    threshold_lut = np.where(levels > threshold, 255, 0).astype(np.uint8)
+    image = image.point(threshold_lut[tone_lut].tobytes())
 
     # Step 7: Noise reduction
     # Median filter removes salt-and-pepper noise from anti-aliasing
     # remnants after thresholding. Size 3 is safe for thin bond lines.
-    image = image.filter(ImageFilter.MedianFilter(size=3))
+    # On a 0/255 image the 3x3 median is a majority vote: a pixel is white
+    # when at least 5 of its 9 neighbours are, i.e. when the 3x3 box mean
+    # exceeds 127. A box filter plus threshold gives the exact median
+    # result without any per-pixel sorting.
+    box_mean = cv2.blur(np.asarray(image), (3, 3), borderType=cv2.BORDER_REPLICATE)
+    _, binary = cv2.threshold(box_mean, 127, 255, cv2.THRESH_BINARY)
+    image = Image.fromarray(binary)
+
+    # Measure ink coverage now, before step 8 adds a white border that
+    # would keep an all-black result from ever looking all black.
+    black_fraction = np.count_nonzero(binary == 0) / binary.size
 
     # Step 8: Crop edge artifacts and add white padding
     # Browser selection captures may include partial UI elements at edges.
@@ -179,22 +347,84 @@ def preprocess_image(image):
 
     # Step 9: Resolution normalization
     # Too-small images lack detail for recognition; too-large images
-    # slow processing without accuracy gains.
+    # slow processing without accuracy gains. Large inputs were already
+    # downscaled in step 1, but the step 8 padding can still push the
+    # long side slightly past 1500px, and upscaling a very wide or tall
+    # image must not either, so the scale is always capped at 1500px.
+    # The image is binary at this point, so nearest-neighbour keeps it
+    # strictly black/white instead of reintroducing grey fringes.
     w, h = image.size
     min_dim = min(w, h)
     max_dim = max(w, h)
 
-    if min_dim < 400:
-        scale = 400 / min_dim
-        image = image.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-        w, h = image.size
-        max_dim = max(w, h)
+    scale = 400 / min_dim if min_dim < 400 else 1
+    scale = min(scale, 1500 / max_dim)
+    if scale != 1:
+        image = image.resize((int(w * scale), int(h * scale)), Image.NEAREST)
+
+    return image, black_fraction
+
+
+# Long-lived worker pool that runs all recognition work, for both the
+# single-image and batch endpoints, so concurrent OSRA runs in this
+# process are capped at the pool size. OSRA has no daemon or batch mode,
+# so each image still pays its own OSRA process startup.
+# Under multi-process servers (Gunicorn) set OSRA_WORKERS=1 so the total
+# stays at one OSRA run per worker process rather than workers x CPUs.
+_OSRA_WORKERS = int(os.environ.get('OSRA_WORKERS', os.cpu_count() or 1))
+_recognition_pool = ThreadPoolExecutor(max_workers=_OSRA_WORKERS, thread_name_prefix='osra')
+
+# Upper bound on images per /analyze-molecules request; each one is a
+# full OSRA run.
+_MAX_BATCH_IMAGES = 16
+
+_RECOGNITION_FAILED_MESSAGE = 'Could not recognize molecular structure. Make sure the image contains a clear chemical structure diagram.'
+
+
+def recognize_image(image_file):
+    """
+    Preprocess an uploaded image and recognize it with OSRA, reusing a
+    cached result when the same preprocessed image was seen before.
+
+    Args:
+        image_file: File-like object holding the uploaded image
+
+    Returns:
+        SMILES string or None if recognition failed
+    """
+    # Open and preprocess image
+    image = Image.open(image_file)
+    if image.format == 'JPEG':
+        # Let libjpeg decode at a reduced DCT scale when the capture is
+        # much larger than the 1500px working resolution.
+        image.draft('RGB', (1500, 1500))
+    image, black_fraction = preprocess_image(image)
+
+    # Blank selections (almost all white, or almost all black) cannot
+    # contain a structure; skip launching OSRA for them.
+    if black_fraction < 0.001 or black_fraction > 0.999:
+        print("Image is blank after preprocessing, skipping OSRA")
+        return None
+
+    # Encode once in memory: the bytes are both the cache key and
+    # the OSRA input, so nothing is written to disk on the hot path.
+    # OSRA decodes the PNG immediately, so minimal compression is used.
+    buffer = BytesIO()
+    image.save(buffer, 'PNG', compress_level=1, optimize=False)
+    png_bytes = buffer.getvalue()
+    cache_key = hashlib.sha256(png_bytes).hexdigest()
 
-    if max_dim > 1500:
-        scale = 1500 / max_dim
-        image = image.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+    smiles = _get_cached_smiles(cache_key)
+    if smiles is not None:
+        print("Using cached OSRA result")
+        return smiles
 
-    return image
+    # Run OSRA recognition
+    print("Running OSRA...")
+    smiles = recognize_molecule_with_osra(png_bytes)
+    if smiles:
+        _cache_smiles(cache_key, smiles)
+    return smiles
 
 
 @app.route('/analyze-molecule', methods=['POST'])
@@ -207,58 +437,72 @@ def analyze_molecule():
         if 'image' not in request.files:
             return jsonify({'error': 'No image provided'}), 400
 
-        image_file = request.files['image']
+        smiles = _recognition_pool.submit(recognize_image, request.files['image']).result()
 
-        # Open and preprocess image
-        image = Image.open(image_file)
-        image = preprocess_image(image)
+        if smiles:
+            print(f"Recognized SMILES: {smiles}")
+            return jsonify({
+                'success': True,
+                'smiles': smiles
+            }), 200
+        else:
+            return jsonify({
+                'success': False,
+                'error': _RECOGNITION_FAILED_MESSAGE
+            }), 200
+
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH
+        raise
+    except Exception as e:
+        print(f"Error processing request: {e}")
+        return jsonify({'error': str(e)}), 500
 
-        # Save to temporary file for OSRA
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
-            temp_path = temp_file.name
-            image.save(temp_path, 'PNG')
 
-        try:
-            # Run OSRA recognition
-            print(f"Running OSRA on {temp_path}...")
-            smiles = recognize_molecule_with_osra(temp_path)
+@app.route('/analyze-molecules', methods=['POST'])
+def analyze_molecules():
+    """
+    Batch endpoint that receives several images in one multipart request
+    (field name 'images') and returns a JSON array with one result per
+    image, in upload order. Images are recognized concurrently.
+    """
+    try:
+        image_files = request.files.getlist('images')
+        if not image_files:
+            return jsonify({'error': 'No images provided'}), 400
+        if len(image_files) > _MAX_BATCH_IMAGES:
+            return jsonify({'error': f'Too many images (maximum {_MAX_BATCH_IMAGES} per request)'}), 400
+
+        def analyze(image_file):
+            try:
+                smiles = recognize_image(image_file)
+            except Exception as e:
+                print(f"Error processing {image_file.filename}: {e}")
+                return {'filename': image_file.filename, 'success': False, 'error': str(e)}
 
             if smiles:
-                print(f"Recognized SMILES: {smiles}")
-                return jsonify({
-                    'success': True,
-                    'smiles': smiles
-                }), 200
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': 'Could not recognize molecular structure. Make sure the image contains a clear chemical structure diagram.'
-                }), 200
+                return {'filename': image_file.filename, 'success': True, 'smiles': smiles}
+            return {'filename': image_file.filename, 'success': False, 'error': _RECOGNITION_FAILED_MESSAGE}
 
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        results = list(_recognition_pool.map(analyze, image_files))
 
+        return jsonify(results), 200
+
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH
+        raise
     except Exception as e:
-        print(f"Error processing request: {e}")
+        print(f"Error processing batch request: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint - also checks if OSRA is available"""
-    osra_available = False
-    try:
-        result = subprocess.run(['osra', '--version'], capture_output=True, timeout=5)
-        osra_available = result.returncode == 0
-    except:
-        pass
-
     return jsonify({
         'status': 'ok',
         'message': 'Molecule detector backend is running',
-        'osra_available': osra_available
+        'osra_available': is_osra_available()
     }), 200
 
 
@@ -267,29 +511,25 @@ if __name__ == '__main__':
     print("🧪 Molecule Detection Backend Server - Production Version")
     print("=" * 70)
     print("Server starting on http://localhost:5000")
+    print("For parallel workers: OSRA_WORKERS=1 gunicorn -w $(nproc) -k sync --timeout 600 -b 0.0.0.0:5000 server:app")
     print()
     print("Requirements:")
     print("  - OSRA installed: sudo apt-get install osra")
-    print("  - Python packages: pip install flask flask-cors pillow")
+    print("  - Python packages: pip install flask flask-cors pillow numpy opencv-python-headless")
     print()
     print("Endpoints:")
-    print("  POST /analyze-molecule - Analyze molecule from image (returns SMILES)")
-    print("  GET  /health          - Health check (includes OSRA status)")
+    print("  POST /analyze-molecule  - Analyze molecule from image (returns SMILES)")
+    print("  POST /analyze-molecules - Analyze a batch of images (returns SMILES list)")
+    print("  GET  /health            - Health check (includes OSRA status)")
     print("=" * 70)
     print()
 
     # Check OSRA availability
-    try:
-        result = subprocess.run(['osra', '--version'], capture_output=True, timeout=5)
-        if result.returncode == 0:
-            print("✓ OSRA is installed and ready")
-        else:
-            print("✗ OSRA check failed")
-    except FileNotFoundError:
-        print("✗ WARNING: OSRA not found!")
+    if is_osra_available():
+        print("✓ OSRA is installed and ready")
+    else:
+        print("✗ WARNING: OSRA not found or not working!")
         print("  Install with: sudo apt-get install osra")
-    except Exception as e:
-        print(f"✗ Error checking OSRA: {e}")
 
     print()
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    app.run(debug=False, port=5000, host='0.0.0.0', threaded=True)
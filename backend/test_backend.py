@@ -61,6 +61,28 @@ def test_backend():
     else:
         print(f"✗ Error: {response.status_code}")
         print(f"  {response.text}")
+    
+    print()
+    
+    # Test the batch endpoint with two copies of the test image
+    print("Sending 2 images to /analyze-molecules endpoint...")
+    
+    files = [
+        ('images', ('test1.png', BytesIO(img_bytes.getvalue()), 'image/png')),
+        ('images', ('test2.png', BytesIO(img_bytes.getvalue()), 'image/png')),
+    ]
+    response = requests.post('http://localhost:5000/analyze-molecules', files=files)
+    
+    if response.status_code == 200:
+        print("✓ Batch request successful!\n")
+        for result in response.json():
+            if result.get('success'):
+                print(f"  {result['filename']}: {result['smiles']}")
+            else:
+                print(f"  {result['filename']}: {result.get('error', 'N/A')}")
+    else:
+        print(f"✗ Error: {response.status_code}")
+        print(f"  {response.text}")
 
 if __name__ == '__main__':
     test_backend()